@@ -0,0 +1,135 @@
+import logging
+import socket
+import threading
+import time
+
+from prometheus_client import CollectorRegistry, Gauge, Counter, push_to_gateway
+from prometheus_client import start_http_server, core
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, REGISTRY
+
+# ujson decodes the miner response noticeably faster than the stdlib parser;
+# it is optional, so fall back to the stdlib when it is not installed
+try:
+	import ujson as json
+except ImportError:
+	import json
+
+log = logging.getLogger('claymore-exporter')
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# metric names and help strings are fixed at import time; building them here
+# keeps the prefix concatenation off the per-scrape path (matches NVMLCollector)
+_M_UPTIME			= ('miner_uptime_seconds',			'Miner uptime')
+_M_HASHRATE			= ('miner_hashrate_hs',				'Miner hashrate')
+_M_SHARES_ACCEPTED	= ('miner_shares_accepted_total',	'Miner accepted shares')
+_M_SHARES_REJECTED	= ('miner_shares_rejected_total',	'Miner rejected shares')
+_M_SHARES_INVALID	= ('miner_shares_invalid_total',	'Miner invalid shares')
+_M_POOL_SWITCHES	= ('miner_pool_switches_total',		'Miner pool switches')
+
+class ClaymoreCollector(object):
+
+	CLAYMORE_API_CALL_GETSTAT = {'id': 0, 'jsonrpc': '2.0', 'method': 'miner_getstat1'}
+
+	CLAYMORE_API_RESULT_UPTIME		= 1
+	CLAYMORE_API_RESULT_ETH_TOTALS	= 2
+	CLAYMORE_API_RESULT_TEMP_FAN	= 6
+	CLAYMORE_API_RESULT_EVENTS		= 8
+
+	def __init__(self, labels, host, port):
+		self.labels	= labels
+		self.host	= host
+		self.port	= port
+
+		# label lists never change, so build them once instead of walking
+		# the dict for every metric on every scrape (matches NVMLCollector)
+		self._label_keys	= list(self.labels.keys())
+		self._label_values	= tuple(self.labels.values())
+
+		# the Claymore API is a persistent JSON-RPC endpoint, so keep one
+		# socket open across scrapes and serialize the request only once
+		self._request_bytes	= json.dumps(self.CLAYMORE_API_CALL_GETSTAT).encode()
+		self._sock			= None
+		# collects run concurrently (threaded WSGI scrapes, the gateway
+		# pusher, the shared-socket server); serialize the whole send/recv
+		# exchange so responses cannot interleave across threads
+		self._io_lock		= threading.Lock()
+
+		# exponential backoff while the miner is unreachable, so a dead peer
+		# costs nothing per scrape instead of a connect timeout
+		self._fail_count	= 0
+		self._next_try_ts	= 0.0
+
+	def _connect(self):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.settimeout(1.0)
+		sock.connect((self.host, self.port))
+		return sock
+
+	def getAPIStat(self):
+		with self._io_lock:
+			if _monotonic() < self._next_try_ts:
+				return None
+			# two attempts so a connection dropped by the miner between scrapes
+			# gets transparently re-established once
+			for attempt in (1, 2):
+				try:
+					if self._sock is None:
+						self._sock = self._connect()
+					self._sock.sendall(self._request_bytes)
+					response = self._sock.recv(4096)
+					if response:
+						self._fail_count = 0
+						return json.loads(response.decode())['result']
+				except (socket.error, ValueError, KeyError) as e:
+					log.debug('miner API request failed (attempt %d): %s', attempt, e)
+				if self._sock is not None:
+					self._sock.close()
+					self._sock = None
+			self._fail_count += 1
+			self._next_try_ts = _monotonic() + min(300, 2 ** self._fail_count)
+			return None
+
+	def collect(self):
+		try:
+			stat = self.getAPIStat()
+			if stat is None:
+				return
+
+			# split every ';'-delimited field once, then just index and
+			# convert the slices we report on
+			parts = [str(field).split(';') for field in stat]
+			uptime_minutes = float(stat[self.CLAYMORE_API_RESULT_UPTIME])
+			eth_hashrate_khs, eth_accepted, eth_rejected = map(float, parts[self.CLAYMORE_API_RESULT_ETH_TOTALS][:3])
+			eth_invalid, eth_pool_switches = map(float, parts[self.CLAYMORE_API_RESULT_EVENTS][:2])
+
+			metric = CounterMetricFamily(_M_UPTIME[0], _M_UPTIME[1], labels=self._label_keys)
+			metric.add_metric(self._label_values, uptime_minutes * 60)
+			yield metric
+			metric = GaugeMetricFamily(_M_HASHRATE[0], _M_HASHRATE[1], labels=self._label_keys)
+			metric.add_metric(self._label_values, eth_hashrate_khs * 1000)
+			yield metric
+			metric = CounterMetricFamily(_M_SHARES_ACCEPTED[0], _M_SHARES_ACCEPTED[1], labels=self._label_keys)
+			metric.add_metric(self._label_values, eth_accepted)
+			yield metric
+			metric = CounterMetricFamily(_M_SHARES_REJECTED[0], _M_SHARES_REJECTED[1], labels=self._label_keys)
+			metric.add_metric(self._label_values, eth_rejected)
+			yield metric
+			metric = CounterMetricFamily(_M_SHARES_INVALID[0], _M_SHARES_INVALID[1], labels=self._label_keys)
+			metric.add_metric(self._label_values, eth_invalid)
+			yield metric
+			metric = CounterMetricFamily(_M_POOL_SWITCHES[0], _M_POOL_SWITCHES[1], labels=self._label_keys)
+			metric.add_metric(self._label_values, eth_pool_switches)
+			yield metric
+
+			log.info('collected hashrate:%.1fkH/s shares:%d/%d', eth_hashrate_khs, eth_accepted, eth_rejected)
+		except Exception as e:
+			log.warning(e, exc_info=True)
+
+# interface expected by docker-entrypoint.py --miner-module
+MinerCollector = ClaymoreCollector
+
+def launch(args, metadata, gpu_uuid_short):
+	# the miner itself runs in its own container; just keep the wrapper alive
+	while True:
+		time.sleep(3600)
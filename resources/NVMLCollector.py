@@ -1,4 +1,17 @@
+import copy
 import logging
+import threading
+import time
+
+from collections import namedtuple
+
+# NVML calls release the GIL while inside the driver, so issuing them from a
+# small pool shrinks scrape latency to roughly the slowest single call;
+# optional because the Python 2 stdlib has no concurrent.futures
+try:
+	from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+	ThreadPoolExecutor = None
 
 from prometheus_client import CollectorRegistry, Gauge, Counter, push_to_gateway
 from prometheus_client import start_http_server, core
@@ -8,56 +21,370 @@ from pynvml import *
 
 log = logging.getLogger('nvml-exporter')
 
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# NVML exposes some fields through the batched nvmlDeviceGetFieldValues API,
+# which retrieves several values in a single driver round-trip instead of one
+# ioctl per query.  Which fields exist depends on the driver/bindings
+# generation (the 375/384-era bindings expose almost none of them), so resolve
+# the names at import time and keep the per-field calls as fallback.
+_FIELD_VALUE_CANDIDATES = (
+	('clock_gpu_mhz',		('NVML_FI_DEV_GPU_CLOCK', 'NVML_FI_DEV_SM_CLOCK')),
+	('clock_mem_mhz',		('NVML_FI_DEV_MEM_CLOCK',)),
+	('temperature_gpu_c',	('NVML_FI_DEV_GPU_TEMP',)),
+	('fan_speed_percent',	('NVML_FI_DEV_FAN_SPEED_0',)),
+	('power_usage_mw',		('NVML_FI_DEV_POWER_USAGE', 'NVML_FI_DEV_POWER_INSTANT')),
+	('memory_used_bytes',	('NVML_FI_DEV_MEMORY_USED',)),
+)
+
+def _resolveFieldIds():
+	fields = []
+	for key, names in _FIELD_VALUE_CANDIDATES:
+		for name in names:
+			if name in globals():
+				fields.append((globals()[name], key))
+				break
+	return fields
+
+_BATCH_FIELDS = _resolveFieldIds()
+
+def _valueAsNumber(value_type, value):
+	if value_type == NVML_VALUE_TYPE_DOUBLE:
+		return value.dVal
+	if value_type == NVML_VALUE_TYPE_UNSIGNED_INT:
+		return value.uiVal
+	if value_type == NVML_VALUE_TYPE_UNSIGNED_LONG:
+		return value.ulVal
+	if value_type == NVML_VALUE_TYPE_UNSIGNED_LONG_LONG:
+		return value.ullVal
+	return value.sllVal
+
+# one scrape's worth of dynamic values; a namedtuple is cheaper than a dict
+# (no per-read key hashing) and gives the fields C-level attribute access
+NVMLReading = namedtuple('NVMLReading', [
+	'clock_gpu_hz',
+	'clock_mem_hz',
+	'gpu_temperature_c',
+	'fan_speed_percent',
+	'power_draw_watt',
+	'power_draw_watt_max',
+	'power_state',
+	'gpu_utilization_percent',
+	'memory_used_bytes',
+])
+
+# metric names and help strings are fixed at import time; building them here
+# keeps all prefix concatenation out of the per-instance and per-scrape paths
+_METRIC_SPECS = {
+	'clock_gpu_hz':			('nvml_clock_gpu_hz',			'NVML GPU clock'),
+	'clock_mem_hz':			('nvml_clock_mem_hz',			'NVML MEM clock'),
+	'gpu_temperature_c':	('nvml_gpu_temperature_c',		'NVML GPU temperature'),
+	'fan_speed_percent':	('nvml_fan_speed_percent',		'NVML fan speed'),
+	'power_draw_watt':		('nvml_power_draw_watt',		'NVML power draw'),
+	'power_draw_watt_max':	('nvml_power_draw_watt_max',	'NVML max power draw over the sampling interval'),
+	'power_state':			('nvml_power_state',			'NVML power state'),
+	'gpu_utilization_percent':	('nvml_gpu_utilization_percent',	'NVML GPU utilization'),
+	'memory_total_bytes':	('nvml_memory_total_bytes',		'NVML total memory'),
+	'memory_used_bytes':	('nvml_memory_used_bytes',		'NVML used memory'),
+}
+
+class BackgroundSampler(threading.Thread):
+	"""Refreshes a collector's reading on its own clock.
+
+	With a sampler attached, collect() serves the latest snapshot instead
+	of querying NVML, so scrape latency no longer depends on GPU or driver
+	latency no matter how often Prometheus asks.
+	"""
+
+	# a move smaller than this is sensor noise, not a change worth
+	# signalling (mirrors the idle thresholds of the gateway push loop)
+	_CHANGE_EPSILON = {
+		'gpu_temperature_c':		1,
+		'power_draw_watt':			5,
+		'gpu_utilization_percent':	5,
+	}
+
+	def __init__(self, collector, interval, change_event=None):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self._collector = collector
+		self._interval = interval
+		self._change_event = change_event
+
+	def _changed(self, old, new):
+		if old is None:
+			return True
+		for field, epsilon in self._CHANGE_EPSILON.items():
+			old_value = getattr(old, field)
+			new_value = getattr(new, field)
+			if old_value is None or new_value is None:
+				if old_value != new_value:
+					return True
+			elif abs(new_value - old_value) > epsilon:
+				return True
+		return False
+
+	def run(self):
+		while True:
+			try:
+				reading = self._collector._read()
+			except Exception as e:
+				log.warning('background sample failed: %s', e)
+				reading = None
+			if reading is not None:
+				with self._collector._snapshot_lock:
+					previous = self._collector._snapshot
+					self._collector._snapshot = reading
+				if self._change_event is not None and self._changed(previous, reading):
+					self._change_event.set()
+			time.sleep(self._interval)
+
 class NVMLCollector(object):
 
+	# the driver refreshes these sensors internally only every few tens of
+	# milliseconds; a re-query inside that window returns the identical
+	# value, so short per-group TTLs make high-frequency scrapes nearly free
+	_TTL_SECONDS = {
+		'batched':		0.05,
+		'clocks':		0.05,
+		'temperature':	0.5,
+		'fan':			1.0,
+		'power':		0.1,
+		'utilization':	0.1,
+		'memory':		0.2,
+	}
+
 	def __init__(self, labels, device):
 		self.labels	= labels
 		self.device	= device
 
-		self.prefix		= 'nvml_'
-		self.prefix_s	= 'NVML '
+		# immutable device attributes, queried once here instead of on every scrape
+		self.mem_total	= nvmlDeviceGetMemoryInfo(device).total
 
-	def collect(self):
+		# nvmlDeviceGetSamples bookkeeping: last-seen timestamp per sampling
+		# type, and the types this device turned out not to support
+		self._last_sample_ts		= {}
+		self._samples_unsupported	= set()
+
+		# (timestamp, value) per sensor group, see _TTL_SECONDS
+		self._cache = {}
+
+		self._pool = ThreadPoolExecutor(max_workers=4) if ThreadPoolExecutor is not None else None
+
+		# optional background sampling, see startSampler()
+		self._sampler		= None
+		self._snapshot		= None
+		self._snapshot_lock	= threading.Lock()
+
+		# most recent full reading, see lastReading()
+		self._last_reading	= None
+
+		# label lists never change, so build them once instead of
+		# traversing dicts on every scrape
+		self._label_keys	= list(self.labels.keys())
+		self._label_values	= tuple(self.labels.values())
+		# one validated template per metric; _gauge() hands out shallow
+		# copies, so concurrent collects never share a samples list
+		self._metrics = dict(
+			(key, GaugeMetricFamily(name, help_text, labels=self._label_keys))
+			for key, (name, help_text) in _METRIC_SPECS.items())
+
+	def _gauge(self, key, value):
+		# the http server, the gateway pusher and the shared-socket server
+		# can all collect concurrently, so never mutate the template: copy
+		# it and give the copy its own samples list
+		metric = copy.copy(self._metrics[key])
+		metric.samples = []
+		metric.add_metric(self._label_values, value)
+		return metric
+
+	def _queryFieldValues(self):
+		"""Fetch every batchable field in one driver round-trip."""
+		if not _BATCH_FIELDS:
+			return {}
 		try:
-			log.debug('Querying for clocks information...')
-			graphics_clock_mhz = nvmlDeviceGetClockInfo(self.device, NVML_CLOCK_GRAPHICS)
-			metric = GaugeMetricFamily(self.prefix + 'clock_gpu_hz', self.prefix_s + "GPU clock", labels=self.labels.keys())
-			metric.add_metric(self.labels.values(), graphics_clock_mhz * 1000000)
-			yield metric
-			mem_clock_mhz = nvmlDeviceGetClockInfo(self.device, NVML_CLOCK_MEM)
-			metric = GaugeMetricFamily(self.prefix + 'clock_mem_hz', self.prefix_s + "MEM clock", labels=self.labels.keys())
-			metric.add_metric(self.labels.values(), mem_clock_mhz * 1000000)
-			yield metric
-
-			log.debug('Querying for temperature information...')
-			gpu_temperature_c = nvmlDeviceGetTemperature(self.device, NVML_TEMPERATURE_GPU)
-			metric = GaugeMetricFamily(self.prefix + 'gpu_temperature_c', self.prefix_s + "GPU temperature", labels=self.labels.keys())
-			metric.add_metric(self.labels.values(), gpu_temperature_c)
-			yield metric
-
-			log.debug('Querying for fan information...')
-			metric = GaugeMetricFamily(self.prefix + 'fan_speed_percent', self.prefix_s + "fan speed", labels=self.labels.keys())
-			metric.add_metric(self.labels.values(), nvmlDeviceGetFanSpeed(self.device))
-			yield metric
-
-			log.debug('Querying for power information...')
-			power_usage_w = nvmlDeviceGetPowerUsage(self.device) / 1000.0
-			metric = GaugeMetricFamily(self.prefix + 'power_draw_watt', self.prefix_s + "power draw", labels=self.labels.keys())
-			metric.add_metric(self.labels.values(), power_usage_w)
-			yield metric
-			metric = GaugeMetricFamily(self.prefix + 'power_state', self.prefix_s + "power state", labels=self.labels.keys())
-			metric.add_metric(self.labels.values(), nvmlDeviceGetPowerState(self.device))
-			yield metric
-
-			log.debug('Querying for memory information...')
-			mem_info = nvmlDeviceGetMemoryInfo(self.device)
-			metric = GaugeMetricFamily(self.prefix + 'memory_total_bytes', self.prefix_s + "total memory", labels=self.labels.keys())
-			metric.add_metric(self.labels.values(), mem_info.total)
-			yield metric
-			metric = GaugeMetricFamily(self.prefix + 'memory_used_bytes', self.prefix_s + "used memory", labels=self.labels.keys())
-			metric.add_metric(self.labels.values(), mem_info.used)
-			yield metric
-
-			log.info('collected power:%.1fW temp:%dc gpu:%dMHz mem:%dMHz', power_usage_w, gpu_temperature_c, graphics_clock_mhz, mem_clock_mhz)
-		except Exception as e:
-			log.warning(e, exc_info=True)
\ No newline at end of file
+			values = nvmlDeviceGetFieldValues(self.device, [field_id for field_id, _ in _BATCH_FIELDS])
+		except NVMLError as e:
+			log.debug('batched field query failed, falling back to per-field calls: %s', e)
+			return {}
+		batched = {}
+		for (_, key), field_value in zip(_BATCH_FIELDS, values):
+			if field_value.nvmlReturn == NVML_SUCCESS:
+				batched[key] = _valueAsNumber(field_value.valueType, field_value.value)
+		return batched
+
+	def _readSamples(self, sampling_type):
+		"""Average and max over all samples NVML buffered since the last scrape.
+
+		One nvmlDeviceGetSamples call returns the driver's whole internal
+		buffer for the interval, instead of the single instantaneous value a
+		point query would give.  Returns None when the device does not
+		support sampling or no new samples have accumulated yet.
+		"""
+		if sampling_type in self._samples_unsupported:
+			return None
+		try:
+			value_type, samples = nvmlDeviceGetSamples(self.device, sampling_type, self._last_sample_ts.get(sampling_type, 0))
+		except NVMLError as e:
+			if getattr(e, 'value', None) == NVML_ERROR_NOT_SUPPORTED:
+				self._samples_unsupported.add(sampling_type)
+			return None
+		if not samples:
+			return None
+		values = [_valueAsNumber(value_type, sample.sampleValue) for sample in samples]
+		self._last_sample_ts[sampling_type] = samples[-1].timeStamp
+		return sum(values) / float(len(values)), max(values)
+
+	def _safeRead(self, key, reader):
+		# a failing sensor drops only its own gauges from the scrape, and a
+		# typed except stays off the expensive traceback-capture path
+		try:
+			return self._cached(key, reader)
+		except NVMLError as e:
+			log.debug('%s query failed: %s', key, e)
+			return None
+
+	def _cached(self, key, reader):
+		entry = self._cache.get(key)
+		now = _monotonic()
+		if entry is not None and now - entry[0] < self._TTL_SECONDS[key]:
+			return entry[1]
+		value = reader()
+		self._cache[key] = (now, value)
+		return value
+
+	def _read(self):
+		"""Query every dynamic value for the device in one pass."""
+		batched = self._cached('batched', self._queryFieldValues)
+
+		def readClocks():
+			clock_gpu_mhz = batched.get('clock_gpu_mhz')
+			if clock_gpu_mhz is None:
+				clock_gpu_mhz = nvmlDeviceGetClockInfo(self.device, NVML_CLOCK_GRAPHICS)
+			clock_mem_mhz = batched.get('clock_mem_mhz')
+			if clock_mem_mhz is None:
+				clock_mem_mhz = nvmlDeviceGetClockInfo(self.device, NVML_CLOCK_MEM)
+			return clock_gpu_mhz, clock_mem_mhz
+
+		def readTemperature():
+			gpu_temperature_c = batched.get('temperature_gpu_c')
+			if gpu_temperature_c is None:
+				gpu_temperature_c = nvmlDeviceGetTemperature(self.device, NVML_TEMPERATURE_GPU)
+			return gpu_temperature_c
+
+		def readFan():
+			fan_speed_percent = batched.get('fan_speed_percent')
+			if fan_speed_percent is None:
+				fan_speed_percent = nvmlDeviceGetFanSpeed(self.device)
+			return fan_speed_percent
+
+		def readPower():
+			power_samples = self._readSamples(NVML_TOTAL_POWER_SAMPLES)
+			if power_samples is not None:
+				power_usage_mw, power_max_mw = power_samples
+			else:
+				power_usage_mw = batched.get('power_usage_mw')
+				if power_usage_mw is None:
+					power_usage_mw = nvmlDeviceGetPowerUsage(self.device)
+				power_max_mw = power_usage_mw
+			return power_usage_mw, power_max_mw, nvmlDeviceGetPowerState(self.device)
+
+		def readUtilization():
+			utilization_samples = self._readSamples(NVML_GPU_UTILIZATION_SAMPLES)
+			if utilization_samples is not None:
+				return utilization_samples[0]
+			return nvmlDeviceGetUtilizationRates(self.device).gpu
+
+		def readMemory():
+			memory_used_bytes = batched.get('memory_used_bytes')
+			if memory_used_bytes is None:
+				memory_used_bytes = nvmlDeviceGetMemoryInfo(self.device).used
+			return memory_used_bytes
+
+		readers = [
+			('clocks',		readClocks),
+			('temperature',	readTemperature),
+			('fan',			readFan),
+			('power',		readPower),
+			('utilization',	readUtilization),
+			('memory',		readMemory),
+		]
+		if self._pool is not None:
+			futures = [self._pool.submit(self._safeRead, key, reader) for key, reader in readers]
+			results = [future.result() for future in futures]
+		else:
+			results = [self._safeRead(key, reader) for key, reader in readers]
+		clocks, gpu_temperature_c, fan_speed_percent, power, gpu_utilization_percent, memory_used_bytes = results
+		clock_gpu_mhz, clock_mem_mhz = clocks if clocks is not None else (None, None)
+		power_usage_mw, power_max_mw, power_state = power if power is not None else (None, None, None)
+
+		reading = NVMLReading(
+			clock_gpu_hz		= clock_gpu_mhz * 1000000 if clock_gpu_mhz is not None else None,
+			clock_mem_hz		= clock_mem_mhz * 1000000 if clock_mem_mhz is not None else None,
+			gpu_temperature_c	= gpu_temperature_c,
+			fan_speed_percent	= fan_speed_percent,
+			power_draw_watt		= power_usage_mw / 1000.0 if power_usage_mw is not None else None,
+			power_draw_watt_max	= power_max_mw / 1000.0 if power_max_mw is not None else None,
+			power_state			= power_state,
+			gpu_utilization_percent	= gpu_utilization_percent,
+			memory_used_bytes	= memory_used_bytes,
+		)
+		self._last_reading = reading
+		return reading
+
+	def lastReading(self):
+		"""Most recent reading a scrape or the sampler produced, or None.
+
+		Lets the gateway pusher reuse values NVML was already asked for
+		instead of issuing its own driver queries on another thread.
+		"""
+		with self._snapshot_lock:
+			if self._snapshot is not None:
+				return self._snapshot
+		return self._last_reading
+
+	def startSampler(self, interval, change_event=None):
+		"""Decouple collection from scraping: sample NVML every interval
+		seconds on a background thread and let collect() serve the snapshot.
+
+		When change_event is given, the sampler sets it whenever the
+		snapshot moved beyond sensor noise, so a pusher can react to real
+		changes instead of polling on a timer.
+		"""
+		self._sampler = BackgroundSampler(self, interval, change_event)
+		self._sampler.start()
+
+	def collect(self):
+		if self._sampler is not None:
+			with self._snapshot_lock:
+				reading = self._snapshot
+			if reading is None:
+				return
+		else:
+			try:
+				reading = self._read()
+			except NVMLError as e:
+				log.warning('NVML read failed: %s', e)
+				return
+			except Exception as e:
+				log.warning(e, exc_info=log.isEnabledFor(logging.DEBUG))
+				return
+
+		values = (
+			('clock_gpu_hz',			reading.clock_gpu_hz),
+			('clock_mem_hz',			reading.clock_mem_hz),
+			('gpu_temperature_c',		reading.gpu_temperature_c),
+			('fan_speed_percent',		reading.fan_speed_percent),
+			('power_draw_watt',			reading.power_draw_watt),
+			('power_draw_watt_max',		reading.power_draw_watt_max),
+			('power_state',				reading.power_state),
+			('gpu_utilization_percent',	reading.gpu_utilization_percent),
+			('memory_total_bytes',		self.mem_total),
+			('memory_used_bytes',		reading.memory_used_bytes),
+		)
+		for key, value in values:
+			if value is not None:
+				yield self._gauge(key, value)
+
+		if reading.power_draw_watt is not None and reading.gpu_temperature_c is not None:
+			log.info('collected power:%.1fW temp:%dc', reading.power_draw_watt, reading.gpu_temperature_c)
\ No newline at end of file
@@ -1,23 +1,24 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
 """
 Pushes nVidia GPU metrics to a Prometheus Push gateway for later collection.
 """
 
 import argparse
+import fcntl
 import logging
+import os
+import socket
+import threading
 import time
 import platform
 
-import socket
-import os
-import urllib2
-import json
 import importlib
 
 from prometheus_client import CollectorRegistry, Gauge, Counter, push_to_gateway
-from prometheus_client import start_http_server, core
+from prometheus_client import start_http_server, core, generate_latest
 from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, REGISTRY
+from prometheus_client.parser import text_string_to_metric_families
 
 from pynvml import *
 
@@ -25,6 +26,111 @@ import NVMLCollector
 
 log = logging.getLogger('miner-wrapper')
 
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# reuse one TCP connection across gateway pushes instead of paying a fresh
+# handshake every period; requests is optional and the prometheus_client
+# default handler remains the fallback
+try:
+	import requests
+	from requests.adapters import HTTPAdapter
+	_push_session = requests.Session()
+	_push_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+except ImportError:
+	requests = None
+	_push_session = None
+
+def _session_handler(url, method, timeout, headers, data):
+	def handle():
+		response = _push_session.request(method, url, data=data, headers=dict(headers), timeout=timeout)
+		if response.status_code >= 400:
+			raise IOError('error talking to pushgateway: %d %s' % (response.status_code, response.reason))
+	return handle
+
+def _push(gateway, hostname):
+	if _push_session is not None:
+		push_to_gateway(gateway, job=hostname, registry=REGISTRY, handler=_session_handler)
+	else:
+		push_to_gateway(gateway, job=hostname, registry=REGISTRY)
+
+# several containers on one host would otherwise each hold an NVML session
+# and duplicate every driver query; the first exporter to grab the lock owns
+# NVML and serves its metrics over a unix socket, later ones proxy from it
+_SHARED_LOCK_PATH = '/tmp/nvml-exporter.lock'
+_SHARED_SOCK_PATH = '/tmp/nvml-exporter.sock'
+_shared_lock_file = None
+
+def _tryAcquireSharedLock():
+	"""Elect the exporter that owns NVML on this host.
+
+	Returns (is_leader, lock_file); the file must stay referenced for as
+	long as the lock should be held.  If the lock file cannot even be
+	opened, run standalone so a broken /tmp never disables metrics.
+	"""
+	try:
+		lock_file = open(_SHARED_LOCK_PATH, 'w')
+	except (IOError, OSError) as e:
+		log.debug('cannot open shared-exporter lock, running standalone: %s', e)
+		return True, None
+	try:
+		fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except (IOError, OSError):
+		lock_file.close()
+		return False, None
+	return True, lock_file
+
+def _serveSharedMetrics(listener):
+	while True:
+		try:
+			conn, _ = listener.accept()
+			conn.sendall(generate_latest(REGISTRY))
+			conn.close()
+		except Exception as e:
+			log.debug('shared metrics connection failed: %s', e)
+
+def _startSharedMetricsServer():
+	try:
+		if os.path.exists(_SHARED_SOCK_PATH):
+			os.unlink(_SHARED_SOCK_PATH)
+		listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		listener.bind(_SHARED_SOCK_PATH)
+		listener.listen(2)
+	except (IOError, OSError, socket.error) as e:
+		log.debug('not exposing shared metrics socket: %s', e)
+		return
+	server = threading.Thread(target=_serveSharedMetrics, args=(listener,))
+	server.daemon = True
+	server.start()
+
+class SharedNVMLProxyCollector(object):
+	"""Re-exports the nvml_* metrics of the exporter that owns NVML."""
+
+	def collect(self):
+		try:
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			sock.settimeout(2.0)
+			sock.connect(_SHARED_SOCK_PATH)
+			chunks = []
+			while True:
+				chunk = sock.recv(65536)
+				if not chunk:
+					break
+				chunks.append(chunk)
+			sock.close()
+		except (IOError, OSError, socket.error) as e:
+			log.debug('shared metrics proxy failed: %s', e)
+			return
+		for family in text_string_to_metric_families(b''.join(chunks).decode('utf-8')):
+			if family.name.startswith('nvml_'):
+				yield family
+
+def _toStr(value):
+	# pynvml returns bytes on Python 3; decode once where the label is built
+	# so the exposition writer never has to re-encode per sample
+	if isinstance(value, bytes):
+		return value.decode('ascii')
+	return value
+
 def _create_parser():
 	parser = argparse.ArgumentParser(description='nVidia GPU Prometheus Metrics Exporter')
 	parser.add_argument('--verbose',
@@ -34,7 +140,16 @@ def _create_parser():
 	parser.add_argument('-u', '--update-period',
 						help='Period between calls to update metrics, '
 							 'in seconds. Defaults to 30.',
-						default=30)
+						type=float,
+						default=30.0)
+
+	parser.add_argument('-si', '--sample-interval',
+						help='If non-zero, sample NVML on a background thread '
+							 'every this many seconds and serve scrapes from '
+							 'the latest snapshot instead of querying inline. '
+							 'Defaults to 0 (query on every scrape).',
+						type=float,
+						default=0.0)
 
 	parser.add_argument('-g', '--gateway',
 						help='If defined, gateway to push metrics to. Should '
@@ -60,55 +175,191 @@ def _create_parser():
 						required=True)
 	return parser
 
-def collect(Miner, args):
-	log.debug('initializing NVML...')
-	nvmlInit()
-
-	log.info('started with nVidia driver version = %s', 
-	nvmlSystemGetDriverVersion())
-
-	log.debug('obtaining device ...')
-	nvml_device = nvmlDeviceGetHandleByIndex(0)
+def startCollectors(Miner, args, nvml_devices):
+	"""Register the collectors and start the export side in this process.
 
+	NVML is initialized exactly once by main(), which passes the device
+	handles in; one NVMLCollector is registered per device.  The http
+	server and the optional gateway pusher each run on a daemon thread, so
+	the caller keeps the main thread for the miner itself.
+	"""
 	log.debug('querying for ID information...')
-	labels = {
-		'gpu_uuid':		nvmlDeviceGetUUID(nvml_device) ,
-		'pci_bus_id':	nvmlDeviceGetPciInfo(nvml_device).busId
-		}
-	log.debug('device is %s', labels['gpu_uuid'])
-
-	REGISTRY.register(NVMLCollector.NVMLCollector(labels, nvml_device))
-	REGISTRY.register(Miner.MinerCollector(labels, args.miner_host, args.miner_port))
+	device_labels = []
+	for index, nvml_device in enumerate(nvml_devices):
+		labels = {
+			'gpu_uuid':		_toStr(nvmlDeviceGetUUID(nvml_device)),
+			'pci_bus_id':	_toStr(nvmlDeviceGetPciInfo(nvml_device).busId),
+			'gpu_index':	str(index),
+			}
+		log.debug('device %d is %s', index, labels['gpu_uuid'])
+		device_labels.append(labels)
+
+	global _shared_lock_file
+	is_leader, _shared_lock_file = _tryAcquireSharedLock()
+	# with background samplers and a gateway, let the samplers signal when
+	# something actually changed instead of pushing on a fixed timer
+	push_event = None
+	if args.gateway and args.sample_interval:
+		push_event = threading.Event()
+	nvml_collectors = []
+	if is_leader:
+		for labels, nvml_device in zip(device_labels, nvml_devices):
+			collector = NVMLCollector.NVMLCollector(labels, nvml_device)
+			if args.sample_interval:
+				collector.startSampler(args.sample_interval, push_event)
+			REGISTRY.register(collector)
+			nvml_collectors.append(collector)
+		_startSharedMetricsServer()
+	else:
+		log.info('another exporter on this host owns NVML, proxying its metrics')
+		REGISTRY.register(SharedNVMLProxyCollector())
+	REGISTRY.register(Miner.MinerCollector(device_labels[0], args.miner_host, args.miner_port))
 	if args.collector_port:
 		log.debug('starting http server on port %d', args.collector_port)
 		start_http_server(args.collector_port)
 		log.info('HTTP server started on port %d', args.collector_port)
 
+	if args.gateway:
+		if args.collector_port:
+			# the Pushgateway is designed for short-lived batch jobs; a
+			# long-running exporter that already has a scrape endpoint only
+			# adds load there
+			log.warning('--gateway alongside --collector-port is deprecated; '
+						'point Prometheus at the collector port instead')
+		pusher = threading.Thread(target=_pushLoop, args=(args, nvml_collectors, push_event))
+		pusher.daemon = True
+		pusher.start()
+
+def _lastReadings(collectors):
+	# (temperature, power) per device from values the collectors already
+	# hold -- the push just collected the registry, so these are fresh --
+	# instead of issuing extra NVML queries on this thread; None when any
+	# device has no usable reading yet (or in proxy mode, with no collectors)
+	if not collectors:
+		return None
+	readings = []
+	for collector in collectors:
+		reading = collector.lastReading()
+		if reading is None or reading.gpu_temperature_c is None or reading.power_draw_watt is None:
+			return None
+		readings.append((reading.gpu_temperature_c, reading.power_draw_watt))
+	return readings
+
+def _pushLoop(args, nvml_collectors, push_event=None):
+	if push_event is not None:
+		_eventPushLoop(args, push_event)
+		return
+	# back off when the GPUs are sitting idle: once temperature and power
+	# have not moved meaningfully on any device for a few pushes, double the
+	# interval up to a cap, and snap back as soon as something changes
+	base_period = args.update_period
+	interval = base_period
+	stable_pushes = 0
+	last_readings = None
+	hostname = platform.node()
+
+	# schedule against the monotonic clock so the cadence does not drift by
+	# however long each push happens to block
+	next_push = _monotonic()
+
 	while True:
-		if args.gateway:
+		try:
 			log.debug('pushing metrics to gateway at %s...', args.gateway)
-			hostname = platform.node()
-			push_to_gateway(args.gateway, job=hostname, registry=REGISTRY)
+			_push(args.gateway, hostname)
 			log.debug('push complete.')
 
+			readings = _lastReadings(nvml_collectors)
+			if readings is not None and last_readings is not None and all(
+				abs(temperature_c - last_temperature_c) <= 1 and abs(power_w - last_power_w) <= 5
+				for (temperature_c, power_w), (last_temperature_c, last_power_w)
+				in zip(readings, last_readings)):
+				stable_pushes += 1
+				if stable_pushes >= 3:
+					interval = min(interval * 2, 300)
+			else:
+				stable_pushes = 0
+				interval = base_period
+			last_readings = readings
+		except Exception as e:
+			# a gateway restart or DNS blip must not kill this thread; try
+			# again at the base period
+			log.warning('push failed, will retry: %s', e)
+			stable_pushes = 0
+			interval = base_period
+			last_readings = None
+
+		next_push += interval
+		delay = next_push - _monotonic()
+		if delay < 0:
+			log.warning('push overran its %.0fs period by %.1fs', interval, -delay)
+			next_push = _monotonic()
+			delay = 0
+		time.sleep(delay)
+
+# the gateway keeps serving the last pushed value, so when nothing changed a
+# re-push only costs it work; never go quiet longer than this though, so a
+# dead exporter still becomes visible as stale data
+_PUSH_MAX_STALE = 300
+
+def _eventPushLoop(args, push_event):
+	# pushes are driven by the background samplers: wait until one of them
+	# reports a change beyond sensor noise, then push, then hold off for the
+	# configured period so a flapping sensor cannot hammer the gateway
+	hostname = platform.node()
+	while True:
+		triggered = push_event.wait(timeout=_PUSH_MAX_STALE)
+		push_event.clear()
+		try:
+			log.debug('pushing metrics to gateway at %s (%s)...', args.gateway,
+						'change' if triggered else 'max-stale refresh')
+			_push(args.gateway, hostname)
+			log.debug('push complete.')
+		except Exception as e:
+			# a gateway restart or DNS blip must not kill this thread; the
+			# debounce below doubles as the retry delay
+			log.warning('push failed, will retry: %s', e)
+			push_event.set()
 		time.sleep(args.update_period)
 
 
+def _configureLogging(verbose):
+	level = logging.DEBUG if verbose else logging.INFO
+	logging.basicConfig(level=level)
+	# attach a handler directly to the per-scrape loggers and stop
+	# propagation, so each record skips the walk up to the root logger
+	handler = logging.StreamHandler()
+	handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+	for name in ('miner-wrapper', 'nvml-exporter', 'claymore-exporter'):
+		hot_logger = logging.getLogger(name)
+		hot_logger.addHandler(handler)
+		hot_logger.propagate = False
+
+_metadata_cache = None
+_metadata_fetched = False
+
 def getHostMetadata():
+	# host metadata cannot change while the container runs, so fetch and
+	# parse it at most once per process no matter how often it is asked for
+	global _metadata_cache, _metadata_fetched
+	if _metadata_fetched:
+		return _metadata_cache
+	_metadata_fetched = True
+	if _push_session is None:
+		log.info('requests not available, skipping host metadata')
+		return None
 	try:
-		req = urllib2.Request('http://rancher-metadata/2015-12-19/self/host')
-		req.add_header('Accept', 'application/json')
-		resp = urllib2.urlopen(req)
-		metadata = json.loads(resp.read())
-	except socket.error as e:
+		response = _push_session.get('http://rancher-metadata/2015-12-19/self/host',
+									headers={'Accept': 'application/json'},
+									timeout=5)
+		_metadata_cache = response.json()
+	except (requests.RequestException, ValueError) as e:
 		log.info('not able to get metadata: %s', e)
-		return None
-	return metadata
+	return _metadata_cache
 
 def main():
 	parser = _create_parser()
 	args = parser.parse_args()
-	logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+	_configureLogging(args.verbose)
 
 	Miner = importlib.import_module(args.miner_module, package=None)
 
@@ -118,30 +369,32 @@ def main():
 
 		log.info('started with nVidia driver version = %s', nvmlSystemGetDriverVersion())
 
-		log.debug('obtaining device ...')
-		nvml_device = nvmlDeviceGetHandleByIndex(0)
-
-		gpu_uuid = nvmlDeviceGetUUID(nvml_device)
-		device_name = nvmlDeviceGetName(nvml_device)
-		log.info('%s is a %s', gpu_uuid, device_name)
-
-		gpu_uuid_short = gpu_uuid.split('-')[-1]
+		log.debug('obtaining devices ...')
+		device_count = nvmlDeviceGetCount()
+		nvml_devices = [nvmlDeviceGetHandleByIndex(i) for i in range(device_count)]
+		log.info('found %d GPU(s)', device_count)
 
 		metadata = getHostMetadata()
 
-		key = "coolbits-%s"%gpu_uuid_short
-		if key in metadata['labels']:
-			coolbits = metadata['labels'][key].split(',')
+		gpu_uuid_short = None
+		for nvml_device in nvml_devices:
+			gpu_uuid = _toStr(nvmlDeviceGetUUID(nvml_device))
+			device_name = _toStr(nvmlDeviceGetName(nvml_device))
+			log.info('%s is a %s', gpu_uuid, device_name)
+
+			uuid_short = gpu_uuid.split('-')[-1]
+			if gpu_uuid_short is None:
+				gpu_uuid_short = uuid_short
 
-			mW = int(coolbits[0])
-			log.info('setting new power limit: %dmW', mW)
-			nvmlDeviceSetPowerManagementLimit(nvml_device, mW)
+			key = "coolbits-%s"%uuid_short
+			if metadata and key in metadata['labels']:
+				coolbits = metadata['labels'][key].split(',')
 
-		pid = os.fork()
+				mW = int(coolbits[0])
+				log.info('setting new power limit: %dmW', mW)
+				nvmlDeviceSetPowerManagementLimit(nvml_device, mW)
 
-		if ( pid == 0 ):
-			log.info('collect as a child process %d'%os.getpid())
-			collect(Miner, args)
+		startCollectors(Miner, args, nvml_devices)
 
 		Miner.launch(args, metadata, gpu_uuid_short)
 